@@ -1,17 +1,57 @@
 
-import boto3
 import uuid
 import json
 import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import logging
+import os
 import sys
-from typing import Optional
+import threading
+from typing import Iterable, Optional
 from contextlib import AsyncExitStack
 
+from aioconsole import ainput
+from cachetools import TTLCache
+
+# orjson is much faster than the stdlib json, use it when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
-bedrock_agent_client = boto3.client('bedrock-agent')
-bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime')
+logger = logging.getLogger(__name__)
+
+# the boto3 clients are created on first use, boto3 client creation is not thread-safe
+_boto3_client_lock = threading.Lock()
+
+def _bedrock_client(service_name):
+    import boto3
+    from botocore.config import Config
+
+    # keep the TLS connections alive between the initial and the ROC invoke_agent calls
+    # tcp_keepalive sets SO_KEEPALIVE on the sockets of the underlying urllib3 pool
+    config = Config(
+        tcp_keepalive=True,
+        retries={'max_attempts': 3, 'mode': 'adaptive'},
+        connect_timeout=5,
+        read_timeout=120,
+        max_pool_connections=32
+    )
+    with _boto3_client_lock:
+        return boto3.client(service_name, config=config)
+
+# serialize an object to a JSON string, values such as the trace event datetimes fall back to str
+def _json_dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
+    if orjson is not None:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, default=str, option=option).decode()
+    return json.dumps(obj, indent=2 if indent else None, sort_keys=sort_keys, default=str)
 
 ###########################################################
 # The initial restaurant booking agent is created by cdk:  
@@ -19,14 +59,56 @@ bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime')
 booking_agent_id = "5SEE4A1JDS" 
 agent_alias_id = "8QL4VGLSD6"
 
+# local file caching the agent functions already added to the agent (keyed by the server script mtime)
+# and the function schema hash of the agent action group
+tools_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".mcp_tools_cache.json")
+
 # Define a MCP Client class
 class MCPClient:
-    # Use an Amazon Bedrock model
-    MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
-    
-    def __init__(self):
+    def __init__(self, latency_optimized: bool = True, max_concurrent_tool_calls: int = 8, num_sessions: int = 4,
+                 agent_alias_id: str = agent_alias_id, cacheable_tools: Iterable[str] = ()):
         self.session: Optional[ClientSession] = None
+        # the model is configured on the agent, pick the alias of the agent version (and its model or
+        # provisioned throughput) to invoke
+        self.agent_alias_id = agent_alias_id
+        # pool of MCP sessions, each with its own server process, used round-robin by the tool calls
+        self.num_sessions = num_sessions
+        self._sessions: list[ClientSession] = []
+        self._session_cycle = None
+        self._session_lock = asyncio.Lock()
         self.exit_stack = AsyncExitStack()
+        # list_tools response, or the agent functions cached by a previous run for the same server script
+        self._tools_response = None
+        self._tools_cache_key = None
+        self._tools_cache = {}
+        self._cached_agent_functions = None
+        # thread pool for the blocking boto3 Bedrock calls
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+        # use the Bedrock latency-optimized inference for the agent model, set to False for standard latency
+        self.latency_optimized = latency_optimized
+        # upper bound of the MCP tool calls running at the same time for one ROC event
+        self.max_concurrent_tool_calls = max_concurrent_tool_calls
+        # read-only MCP tools whose results can be cached, none by default since a tool may have side effects
+        self.cacheable_tools = frozenset(cacheable_tools)
+        # cache of the read-only MCP tool call results keyed by the tool name and the canonical args
+        self._cache = TTLCache(maxsize=256, ttl=300)
+        self.stats = {'cache_hits': 0, 'cache_misses': 0}
+        # random id of the agent session shared by the chat turns
+        self.session_id: str = uuid.uuid4().hex
+
+    # bedrock agent client, created on first use
+    @functools.cached_property
+    def _agent(self):
+        return _bedrock_client('bedrock-agent')
+
+    # bedrock agent runtime client, created on first use
+    @functools.cached_property
+    def _runtime(self):
+        return _bedrock_client('bedrock-agent-runtime')
+
+    # create the bedrock clients in a worker thread ahead of their first use
+    async def warmup_bedrock_clients(self):
+        await asyncio.to_thread(lambda: (self._agent.meta, self._runtime.meta))
 
     # connect to the server  
     async def connect_to_server(self, server_script_path: str):
@@ -37,19 +119,64 @@ class MCPClient:
         command = "python" if server_script_path.endswith('.py') else "node"
         server_params = StdioServerParameters(command=command, args=[server_script_path], env=None)
 
-        # use stdio transport
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
-        await self.session.initialize()
+        # use stdio transport, one server process per session
+        for _ in range(self.num_sessions):
+            stdio, write = await self.exit_stack.enter_async_context(stdio_client(server_params))
+            self._sessions.append(await self.exit_stack.enter_async_context(ClientSession(stdio, write)))
+        self._session_cycle = itertools.cycle(self._sessions)
+        self.session = self._sessions[0]
+
+        # skip list_tools if the server script is unchanged since the last run
+        self._tools_cache_key = {
+            'agent_id': booking_agent_id,
+            'server_script': os.path.abspath(server_script_path),
+            'mtime': os.path.getmtime(server_script_path)
+        }
+        # read the tools cache while the MCP handshake is in flight, list_tools has to wait for the handshake
+        *_, self._tools_cache = await asyncio.gather(
+            *[session.initialize() for session in self._sessions],
+            asyncio.to_thread(self._load_tools_cache)
+        )
+        if self._tools_cache.get('key') == self._tools_cache_key:
+            self._cached_agent_functions = self._tools_cache.get('agent_functions')
+        if self._cached_agent_functions is not None:
+            print("\nConnected to server with cached tools:", [function['name'] for function in self._cached_agent_functions])
+            return
 
-        response = await self.session.list_tools()
-        print("\nConnected to server with tools:", [tool.name for tool in response.tools])
+        self._tools_response = await self.session.list_tools()
+        print("\nConnected to server with tools:", [tool.name for tool in self._tools_response.tools])
+
+    # load the tools cache written by a previous run, empty if there is none
+    def _load_tools_cache(self):
+        try:
+            with open(tools_cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_tools_cache(self, agent_functions, schema_hash, action_group_id):
+        self._tools_cache = {
+            'key': self._tools_cache_key,
+            'agent_functions': agent_functions,
+            'schema_hash': schema_hash,
+            'action_group_id': action_group_id
+        }
+        # the cache is only an optimization, e.g. a read-only install dir must not fail the startup
+        try:
+            with open(tools_cache_path, 'w') as f:
+                json.dump(self._tools_cache, f)
+        except OSError as e:
+            print(f"\nUnable to write the tools cache {tools_cache_path}: {str(e)}")
 
     # get MCP tools info and transform them to Bedrock agent function definitions
     async def get_tools(self):         
-        # get the list of tools from the MCP server
-        response = await self.session.list_tools()
+        if self._cached_agent_functions is not None:
+            return self._cached_agent_functions
+
+        # reuse the list of tools fetched from the MCP server at connection
+        response = self._tools_response
+        if response is None:
+            response = self._tools_response = await self.session.list_tools()
 
         # extract the tool information
         mcp_tools = [{
@@ -67,25 +194,22 @@ class MCPClient:
         format_b = []
 
         for function in format_a:
-            # Create new function dictionary with basic properties
-            new_function = {
+            # the MCP schema may omit the required list
+            parameters = function['parameters']
+            required_params = set(parameters.get('required', ()))
+
+            # Create new function dictionary with basic properties and converted parameters
+            format_b.append({
                 'name': function['name'],
                 'description': function['description'],
-                'parameters': {}
-            }
-            
-            # Convert parameters
-            properties = function['parameters']['properties']
-            required_params = function['parameters']['required']
-            
-            for param_name, param_info in properties.items():
-                new_function['parameters'][param_name] = {
-                    'description': param_info['title'],
-                    'required': param_name in required_params,
-                    'type': param_info['type']
+                'parameters': {
+                    param_name: {
+                        'description': param_info.get('title', param_name),
+                        'required': param_name in required_params,
+                        'type': param_info['type']
+                    } for param_name, param_info in parameters.get('properties', {}).items()
                 }
-            
-            format_b.append(new_function)    
+            })
         return format_b
     
     # add mcp tools to a Return of Control action group in the agent
@@ -93,26 +217,63 @@ class MCPClient:
         agent_action_group_name = "mcp_tools"
         agent_action_group_description= "Actions for getting the weather or weather alert based on the input two-letter US state code"
 
-        # create a new action group 
-        agent_action_group_response = bedrock_agent_client.create_agent_action_group(
-            agentId=booking_agent_id,
-            agentVersion='DRAFT',
-            actionGroupExecutor={
+        # skip updating the agent if its action group already has the same function schema
+        # hash one fixed canonical JSON form, independent of the installed JSON backend
+        canonical_schema = json.dumps(agent_functions, sort_keys=True, separators=(',', ':'))
+        schema_hash = hashlib.sha256(canonical_schema.encode()).hexdigest()
+        action_group_id = self._find_agent_action_group_id(agent_action_group_name)
+        if (action_group_id is not None
+                and action_group_id == self._tools_cache.get('action_group_id')
+                and schema_hash == self._tools_cache.get('schema_hash')):
+            print("\nagent action group is up to date, skip updating the agent")
+            # the server script may have changed without changing the schema, refresh the cache key
+            if self._tools_cache_key is not None and self._tools_cache.get('key') != self._tools_cache_key:
+                self._save_tools_cache(agent_functions, schema_hash, action_group_id)
+            return
+
+        action_group = {
+            'agentId': booking_agent_id,
+            'agentVersion': 'DRAFT',
+            'actionGroupExecutor': {
                 'customControl': 'RETURN_CONTROL'
             },
-            actionGroupName=agent_action_group_name,
-            functionSchema={
+            'actionGroupName': agent_action_group_name,
+            'functionSchema': {
                 'functions': agent_functions
             },
-            description=agent_action_group_description
-        )
+            'description': agent_action_group_description
+        }
+        if action_group_id is None:
+            # create a new action group 
+            agent_action_group_response = self._agent.create_agent_action_group(**action_group)
+        else:
+            # update the existing action group with the new function schema
+            agent_action_group_response = self._agent.update_agent_action_group(actionGroupId=action_group_id, **action_group)
+        action_group_id = agent_action_group_response['agentActionGroup']['actionGroupId']
 
         # prepare the agent
-        response = bedrock_agent_client.prepare_agent(
+        response = self._agent.prepare_agent(
             agentId=booking_agent_id
         )
         print(response)
 
+        if self._tools_cache_key is not None:
+            self._save_tools_cache(agent_functions, schema_hash, action_group_id)
+
+    # id of the action group with the given name in the draft agent, None if there is none
+    def _find_agent_action_group_id(self, action_group_name):
+        paginator = self._agent.get_paginator('list_agent_action_groups')
+        for page in paginator.paginate(agentId=booking_agent_id, agentVersion='DRAFT'):
+            for summary in page['actionGroupSummaries']:
+                if summary['actionGroupName'] == action_group_name:
+                    return summary['actionGroupId']
+        return None
+
+    # model configurations passed to every invoke_agent call
+    def _bedrock_model_configurations(self):
+        latency = 'optimized' if self.latency_optimized else 'standard'
+        return {'performanceConfig': {'latency': latency}}
+
     # handle a tool call to MCP server and return the result
     async def handle_tool_call(self, function_name, function_args):
 
@@ -124,105 +285,178 @@ class MCPClient:
         print(f"Tool name: {tool_name}")
         print(f"Tool args: {tool_args}")
 
+        # return the cached result of a read-only tool if any
+        cacheable = tool_name in self.cacheable_tools
+        if cacheable:
+            key = self._cache_key(tool_name, tool_args)
+            if key in self._cache:
+                self.stats['cache_hits'] += 1
+                return self._cache[key]
+            self.stats['cache_misses'] += 1
+
         # tool call to the MCP server
-        result = await self.session.call_tool(tool_name, tool_args)
+        session = await self._session()
+        result = await session.call_tool(tool_name, tool_args)
+        if cacheable and not result.isError:
+            self._cache[key] = result
         return result
 
-    # send a query to the agent and get a response
-    async def chat(self, query):
-
-        # invoke bedrock agent
-        # create a random id for session initiator id
-        session_id:str = str(uuid.uuid1())
-        enable_trace:bool = False
-        end_session:bool = False
+    # next MCP session of the pool
+    async def _session(self):
+        async with self._session_lock:
+            return next(self._session_cycle)
+
+    # canonical cache key of a tool call, the MCP progress token does not change the result
+    def _cache_key(self, tool_name, tool_args):
+        args = dict(tool_args)
+        meta = args.pop('_meta', None)
+        if meta:
+            meta = {k: v for k, v in meta.items() if k != 'progressToken'}
+            if meta:
+                args['_meta'] = meta
+        return (tool_name, _json_dumps(args, sort_keys=True))
+
+    # cache hit rate of the MCP tool calls
+    def cache_hit_rate(self):
+        total = self.stats['cache_hits'] + self.stats['cache_misses']
+        return self.stats['cache_hits'] / total if total else 0.0
+
+    # handle all the tool calls of a ROC event concurrently and return their results in the original order
+    async def handle_tool_calls(self, function_inputs):
+        semaphore = asyncio.Semaphore(self.max_concurrent_tool_calls)
+
+        async def bounded_tool_call(function_input):
+            async with semaphore:
+                return await self.handle_tool_call(function_input["function"], function_input["parameters"])
+
+        tool_responses = await asyncio.gather(*[bounded_tool_call(function_input) for function_input in function_inputs])
+
+        tool_results = [tool_response.content[0].text for tool_response in tool_responses]
+        for tool_result in tool_results:
+            print(tool_result)
+        return tool_results
+
+    # session state returning the tool call results of a ROC event to the agent
+    def _make_roc_session_state(self, invocation_id, function_inputs, tool_results):
+        return {
+            'invocationId': invocation_id,
+            'returnControlInvocationResults': [{
+                'functionResult': {
+                    'actionGroup': function_input["actionGroup"],
+                    'function': function_input["function"],
+                    'responseBody': {
+                        "TEXT": {
+                            'body': tool_result
+                        }
+                    }
+                }
+            } for function_input, tool_result in zip(function_inputs, tool_results)]
+        }
 
-        print("\ninvoke the agent ...")
-        # invoke the agent API
-        agentResponse = bedrock_agent_runtime_client.invoke_agent(
-            inputText=query,
-            agentId=booking_agent_id,
-            agentAliasId=agent_alias_id, 
-            sessionId=session_id,
-            enableTrace=enable_trace, 
-            endSession= end_session
-        )
+    # invoke the agent and process its output, runs in the thread pool since boto3 is blocking
+    def _invoke_and_drain(self, invoke_agent_kwargs):
+        agentResponse = self._runtime.invoke_agent(**invoke_agent_kwargs)
         event_stream = agentResponse['completion']
 
         # process the agent output
         function_call = None
-        agent_answer = None
+        # the answer may be split across several chunks, decode them once at the end
+        buf = bytearray()
         try:
             for event in event_stream:
                 if 'returnControl' in event:
+                    # keep reading to the end of the stream, which follows right after the function call,
+                    # so the connection goes back to the pool for the ROC invoke_agent call
                     function_call = event
                 elif 'chunk' in event:
-                    data = event['chunk']['bytes']
-                    agent_answer = data.decode('utf8')
+                    buf.extend(event['chunk']['bytes'])
                 elif 'trace' in event:
-                    print.info(json.dumps(event['trace'], indent=2))
+                    # skip the serialization unless the trace is logged
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(_json_dumps(event['trace'], indent=True))
                 else:
                     raise Exception("unexpected event.", event)
         except Exception as e:
+            # the stream is left half read, drop its connection instead of returning it to the pool
+            close = getattr(event_stream, 'close', None)
+            if close is not None:
+                close()
             raise Exception("unexpected event.", e)
 
+        agent_answer = buf.decode('utf-8') if buf else None
+        return function_call, agent_answer
+
+    # start a new agent session without the previous conversation context
+    def reset_session(self):
+        self.session_id = uuid.uuid4().hex
+
+    # send a query to the agent and get a response
+    async def chat(self, query, session_id: Optional[str] = None):
+
+        # invoke bedrock agent
+        # reuse the session id across the chat turns so that the agent keeps the conversation context
+        if session_id is None:
+            session_id = self.session_id
+        # the agent only sends trace events when they are logged
+        enable_trace:bool = logger.isEnabledFor(logging.DEBUG)
+        end_session:bool = False
+
+        print("\ninvoke the agent ...")
+        # invoke the agent API in the thread pool so the blocking boto3 call does not block the event loop
+        loop = asyncio.get_running_loop()
+        function_call, agent_answer = await loop.run_in_executor(self._pool, self._invoke_and_drain, {
+            'inputText': query,
+            'agentId': booking_agent_id,
+            'agentAliasId': self.agent_alias_id,
+            'sessionId': session_id,
+            'enableTrace': enable_trace,
+            'endSession': end_session,
+            'bedrockModelConfigurations': self._bedrock_model_configurations()
+        })
+
         if function_call != None:
             print("\nreturn function call at the local host ...")
-            # extract the info fromt the ROC function call
-            function_name = function_call["returnControl"]["invocationInputs"][0]["functionInvocationInput"]["function"]
-            function_args = function_call["returnControl"]["invocationInputs"][0]["functionInvocationInput"]["parameters"]
+            # extract the info fromt the ROC function calls
+            return_control = function_call["returnControl"]
+            function_inputs = [item["functionInvocationInput"] for item in return_control["invocationInputs"]]
 
-            # make mcp tool call to the MCP server
-            tool_response = await self.handle_tool_call(function_name, function_args)
-            tool_result = tool_response.content[0].text
-            print(tool_result)
-            
-            # invoke agent the second time with the function call result
+            # make mcp tool calls to the MCP server
+            tool_results = await self.handle_tool_calls(function_inputs)
+
+            # invoke agent the second time with the function call results
             print("\ninvoke the agent the second time due to ROC ...")
-            agentResponse = bedrock_agent_runtime_client.invoke_agent(
-                agentId=booking_agent_id,
-                agentAliasId=agent_alias_id, 
-                sessionId=session_id,
-                enableTrace=enable_trace, 
-                sessionState={
-                    'invocationId': function_call["returnControl"]["invocationId"],
-                    'returnControlInvocationResults': [{
-                            'functionResult': {
-                                'actionGroup': function_call["returnControl"]["invocationInputs"][0]["functionInvocationInput"]["actionGroup"],
-                                'function': function_call["returnControl"]["invocationInputs"][0]["functionInvocationInput"]["function"],
-                                'responseBody': {
-                                    "TEXT": {
-                                        'body': tool_result
-                                    }
-                                }
-                            }
-                            }]}
-            )
-            # print(agentResponse)
-            event_stream = agentResponse['completion']
-
-            # process agent output
-            agent_answer = None
-            try:
-                for event in event_stream:      
-                    if 'chunk' in event:
-                        data = event['chunk']['bytes']
-                        agent_answer = data.decode('utf8')
-                    elif 'trace' in event:
-                        print.info(json.dumps(event['trace'], indent=2))
-                    else:
-                        raise Exception("unexpected event.", event)
-            except Exception as e:
-                raise Exception("unexpected event.", e)
+            function_call, agent_answer = await loop.run_in_executor(self._pool, self._invoke_and_drain, {
+                'agentId': booking_agent_id,
+                'agentAliasId': self.agent_alias_id,
+                'sessionId': session_id,
+                'enableTrace': enable_trace,
+                'bedrockModelConfigurations': self._bedrock_model_configurations(),
+                'sessionState': self._make_roc_session_state(return_control["invocationId"], function_inputs, tool_results)
+            })
+            # only one ROC round-trip is supported
+            if function_call != None:
+                raise Exception("unexpected event.", function_call)
 
         return agent_answer
     
+    # send several queries to the agent concurrently and get their responses in the original order
+    async def chat_many(self, queries: list[str], concurrency: int = 4):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        # an agent session handles one invocation at a time, so every query gets its own session
+        async def one(query):
+            async with semaphore:
+                return await self.chat(query, session_id=uuid.uuid4().hex)
+
+        return await asyncio.gather(*(one(query) for query in queries))
+
     # From: https://community.aws/content/2uFvyCPQt7KcMxD9ldsJyjZM1Wp/model-context-protocol-mcp-and-amazon-bedrock
     async def chat_loop(self):
         print("\nMCP Client Started!\nType your queries or 'quit' to exit.")
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                # read the query without blocking the event loop
+                query = (await ainput("\nQuery: ")).strip()
                 if query.lower() == 'quit':
                     break
                 response = await self.chat(query)
@@ -233,6 +467,7 @@ class MCPClient:
 
     async def cleanup(self):
         await self.exit_stack.aclose()
+        self._pool.shutdown(wait=False)
 
 # run the MCP client 
 async def main():
@@ -240,18 +475,30 @@ async def main():
         print("Usage: python client.py <path_to_server_script>")
         sys.exit(1)
 
-    client = MCPClient()
-    await client.connect_to_server(sys.argv[1])
+    # the weather.py tools only read data
+    client = MCPClient(cacheable_tools={"get_alerts", "get_forecast"})
+    try:
+        # the boto3 client cold start overlaps with the MCP server startup
+        warmup = asyncio.create_task(client.warmup_bedrock_clients())
+        try:
+            await client.connect_to_server(sys.argv[1])
 
-    mcp_tools = await client.get_tools()
-    print("\nmcp_tools:\n", mcp_tools)
+            mcp_tools = await client.get_tools()
+            print("\nmcp_tools:\n", mcp_tools)
 
-    await client.update_bedrock_agent(mcp_tools)
-    print("\nupdated bedrock agent action groups")
+            await warmup
+        finally:
+            # a failed startup must not leave the warmup task unretrieved
+            if not warmup.done():
+                warmup.cancel()
+            await asyncio.gather(warmup, return_exceptions=True)
+
+        await client.update_bedrock_agent(mcp_tools)
+        print("\nupdated bedrock agent action groups")
 
-    try:
         await client.chat_loop()
     finally:
+        # stop the MCP server processes and the thread pool even if the startup fails
         await client.cleanup()
 
 if __name__ == "__main__":